@@ -1,18 +1,37 @@
+import os
 import re
 import sys
+import locale
+import shlex
+import shutil
 import signal
 import argparse
+import threading
 import subprocess
 from enum import Enum
 from pathlib import Path
 from dataclasses import dataclass
 
+try:
+    from re import _parser  # Python >= 3.11
+except ImportError:
+    import sre_parse as _parser
+
 # Trim stacktrace
 sys.tracebacklimit = 0
 
 ESC = "\x1b"             # Escape sequence
 CSI = f"{ESC}["          # Control sequence indicator
-RST_SUFFIX = f"{CSI}0m"  # Reset suffix
+RST_SUFFIX = f"{CSI}0m".encode()  # Reset suffix
+
+# Pipes are read in chunks of whatever is available
+CHUNK_SIZE = 65536
+
+# Both pipes are drained concurrently into stdout
+WRITE_LOCK = threading.Lock()
+
+# Characters that give a keyword regular expression meaning
+SPECIAL = frozenset(".^$*+?{}[]\\|()")
 
 
 class Mode(Enum):
@@ -30,10 +49,10 @@ class Style(Enum):
     # }}}
 
 
-@dataclass
+@dataclass(slots=True)
 class Arguments:
     # Arguments {{{
-    command: list  # Command is required, the rest are optional
+    command: list | str  # Command is required, the rest are optional
     ignore:  bool = False
     mode:     int = Mode.LINE
     style:    int = Style.Bit24
@@ -41,29 +60,50 @@ class Arguments:
     # }}}
 
 
-@dataclass
+@dataclass(slots=True)
 class Configuration:
     # Configuration {{{
     keywords: list  # Indexed list of keywords to match
-    colors:   list  # Indexed list of colors synchronized with keywords
-    baseColor: str  # Indicates the color that non-matched output will be
     hasBase:  bool  # Flag to indicate if a base color was defined
+    replacements: list  # Colorized keywords synchronized with keywords
+    prefixes: list  # Ansi prefixes synchronized with keywords
+    basePrefix: bytes = b""  # Ansi prefix of the base color
+    pattern: re.Pattern = None  # All keywords combined as named groups
+    priority: re.Pattern = None  # Same groups tried in configured order
+    patterns:      list = None  # Each keyword alone if they can't combine
+    literals:      list = None  # Plain text keywords (lowered if ignoring)
+    anchored:      bool = False  # All keywords only match at line start
     # }}}
 
 
 def main() -> None:
     # main {{{
     arguments = set_arguments()
-    configuration = set_configuration(arguments.file, arguments.style)
+    configuration = set_configuration(arguments.file, arguments.style,
+                                      arguments.ignore)
+
+    # Windows won't find scripts (i.e., npm.cmd) without the
+    # shell, resolving them here avoids spawning cmd.exe, the
+    # shell is then only needed for builtins (i.e., dir)
+    command = arguments.command
+    shell = False
+    if sys.platform == "win32":
+        program, rest = split_program(command)
+        executable = shutil.which(program)
+        if executable is None:
+            shell = True
+        else:
+            # Quoted, since the path may contain spaces
+            command = f'"{executable}"{rest}'
 
-    # I have found shell is needed to work with Windows
-    # but causes problems on unix-like systems
-    shell = True if sys.platform == "win32" else False
+    # Output is written straight to the descriptor from here,
+    # looked up now since sys.stdout may have been replaced
+    sys.stdout.flush()
+    stdout = sys.stdout.fileno()
     process = subprocess.Popen(
-            arguments.command,
+            command,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True,
             shell=shell)
 
     def signal_trap(sig, frame) -> None:
@@ -76,27 +116,71 @@ def main() -> None:
 
     signal.signal(signal.SIGINT, signal_trap)
 
+    def log_errors() -> None:
+        """
+        Error output is drained on its own
+        thread so a full pipe can't block
+        the process while stdout is read
+        """
+        with process.stderr:
+            log_stderr(process.stderr, arguments, stdout)
+
     # Separate standard output and error output
     # Error output will default to all red
+    errors = threading.Thread(target=log_errors, daemon=True)
+    errors.start()
     with process.stdout:
-        log_stdout(process.stdout, configuration, arguments)
-    with process.stderr:
-        log_stderr(process.stderr, arguments)
+        log_stdout(process.stdout, configuration, arguments, stdout)
 
+    errors.join()
     process.wait()
     # }}}
 
 
-def colorize(text: str, color: str, style: Style) -> str:
-    # colorize {{{
+def ansi_prefix(color: str, style: Style) -> bytes:
+    # ansi_prefix {{{
+    # Only called while setting up, output is
+    # then just the prefix, text, and RST_SUFFIX
     match style:
         case Style.Bit4:
-            return f"{CSI}{color}m{text}{RST_SUFFIX}"
+            return f"{CSI}{color}m".encode()
         case Style.Bit8:
-            return f"{CSI}38;5;{color}m{text}{RST_SUFFIX}"
+            return f"{CSI}38;5;{color}m".encode()
         case Style.Bit24:
             r, g, b = color.split(",")
-            return f"{CSI}38;2;{r};{g};{b}m{text}{RST_SUFFIX}"
+            return f"{CSI}38;2;{r};{g};{b}m".encode()
+    # }}}
+
+
+def combinable(pattern: re.Pattern, flags: int) -> bool:
+    """
+    Checks if a keyword means the same
+    once fused with the others into the
+    combined alternation of named groups
+    """
+    # combinable {{{
+    # Inline global flags (i.e., (?i)) would apply to every keyword
+    if pattern.flags != re.compile(pattern.pattern[:0], flags).flags:
+        return False
+
+    def references(value) -> bool:
+        # Numbered references would point at the wrapping
+        # groups, which still compiles but never matches
+        if isinstance(value, _parser.SubPattern):
+            return any(op in (_parser.GROUPREF, _parser.GROUPREF_EXISTS)
+                       or references(av) for op, av in value)
+        if isinstance(value, (tuple, list)):
+            return any(map(references, value))
+        return False
+
+    return not references(_parser.parse(pattern.pattern, pattern.flags))
+    # }}}
+
+
+def group_table(values: list) -> dict:
+    # group_table {{{
+    # Groups are named after the keyword index (i.e., k0, k1)
+    return {f"k{index}": value for index, value in enumerate(values)}
     # }}}
 
 
@@ -117,73 +201,295 @@ def handled(func):
     # }}}
 
 
-def handle_line_mode(line: str, color: str, style: Style) -> None:
+def handle_chunk(configuration: Configuration, process, base: bool):
+    """
+    Builds the chunk processor, which hands
+    whole chunks without any keyword through
+    """
+    # handle_chunk {{{
+    literals = configuration.literals
+
+    if literals is None:
+        # Patterns could match across lines, only
+        # plain text keywords can screen a chunk
+        return lambda lines: list(map(process, lines))
+
+    basePrefix = configuration.basePrefix
+    reset = RST_SUFFIX
+    between = reset + b"\n" + basePrefix
+    ignore = configuration.pattern.flags & re.IGNORECASE
+
+    def process_lines(lines: list) -> list:
+        chunk = b"\n".join(lines)
+        text = chunk.lower() if ignore else chunk
+        if any(map(text.__contains__, literals)):
+            return list(map(process, lines))
+
+        # Keywords have no line feeds, so none in the chunk
+        # means none in any of its lines, all are unmatched
+        if base:
+            return [basePrefix + chunk.replace(b"\n", between) + reset]
+        return [chunk]
+
+    return process_lines
+    # }}}
+
+
+def handle_line_mode(configuration: Configuration, find, base: bool):
+    """
+    Builds the line mode processor, which
+    colors the whole line of the match
+    """
     # handle_line_mode {{{
-    print(colorize(line, color, style), end="")
+    # Everything used per line is bound to the closure
+    # up front, avoiding attribute and global lookups
+    prefixes = group_table(configuration.prefixes)
+    basePrefix = configuration.basePrefix
+    reset = RST_SUFFIX
+    literals = configuration.literals
+    ignore = configuration.pattern.flags & re.IGNORECASE
+    priority = configuration.priority.match
+
+    if literals is not None and len(literals) == 1 and not ignore:
+        # A single plain text keyword needs no pattern
+        # at all, the containment check is the search
+        literal = literals[0]
+        prefix = configuration.prefixes[0]
+
+        def process(line: bytes) -> bytes:
+            if literal in line:
+                return prefix + line + reset
+            return basePrefix + line + reset if base else line
+    elif literals is not None:
+        # Plain text keywords are checked with containment, far
+        # cheaper than the pattern, the first configured wins
+        candidates = list(zip(literals, configuration.prefixes))
+
+        def process(line: bytes) -> bytes:
+            # Lowered once per line rather than once per keyword
+            text = line.lower() if ignore else line
+
+            # Mapping the bound method keeps the check in C,
+            # most lines are ruled out here without a loop
+            if not any(map(text.__contains__, literals)):
+                return basePrefix + line + reset if base else line
+
+            for literal, prefix in candidates:
+                if literal in text:
+                    return prefix + line + reset
+    elif base:
+        # The single scan rules lines out, only matched
+        # lines are tried again for the first configured
+        def process(line: bytes) -> bytes:
+            if find(line) is None:
+                return basePrefix + line + reset
+            return prefixes[priority(line).lastgroup] + line + reset
+    else:
+        def process(line: bytes) -> bytes:
+            if find(line) is None:
+                return line
+            return prefixes[priority(line).lastgroup] + line + reset
+
+    return process
     # }}}
 
 
-def handle_word_mode(line: str, key: str, color: str,
-                     style: Style, ignore: bool) -> str:
+def handle_patterns(configuration: Configuration, mode: Mode, base: bool):
+    """
+    Builds the processor for keywords that
+    couldn't be combined, each is then
+    tried on its own in configured order
+    """
+    # handle_patterns {{{
+    basePrefix = configuration.basePrefix
+    reset = RST_SUFFIX
+    patterns = configuration.patterns
+
+    if mode == Mode.LINE:
+        candidates = list(zip([pattern.search for pattern in patterns],
+                              configuration.prefixes))
+
+        def process(line: bytes) -> bytes:
+            for search, prefix in candidates:
+                if search(line) is not None:
+                    return prefix + line + reset
+            return basePrefix + line + reset if base else line
+    else:
+        candidates = list(zip([pattern.finditer for pattern in patterns],
+                              configuration.replacements))
+
+        def process(line: bytes) -> bytes:
+            # Earlier keywords claim their spans first, replacing
+            # one at a time could match inside the inserted colors
+            spans = []
+            for finditer, replacement in candidates:
+                for match in finditer(line):
+                    start, end = match.span()
+                    if start < end and all(end <= other[0] or
+                                           other[1] <= start
+                                           for other in spans):
+                        spans.append((start, end, replacement))
+
+            if not spans:
+                return basePrefix + line + reset if base else line
+
+            parts = []
+            position = 0
+            for start, end, replacement in sorted(spans):
+                parts.append(line[position:start])
+                parts.append(replacement)
+                position = end
+            parts.append(line[position:])
+            return b"".join(parts)
+
+    return process
+    # }}}
+
+
+def handle_word_mode(configuration: Configuration, find, base: bool):
+    """
+    Builds the word mode processor, which
+    colors every match in the same pass
+    """
     # handle_word_mode {{{
-    replace = colorize(key, color, style)
-    update = re.sub(key, replace, line) if ignore is False \
-        else re.sub(key, replace, line, flags=re.IGNORECASE)
-    return update
+    # Replacements are prebuilt, a callable also
+    # avoids parsing them as templates on every call
+    replacements = group_table(configuration.replacements)
+    basePrefix = configuration.basePrefix
+    reset = RST_SUFFIX
+    literals = configuration.literals
+    ignore = configuration.pattern.flags & re.IGNORECASE
+    sub = configuration.pattern.sub
+
+    def replace(match: re.Match) -> bytes:
+        return replacements[match.lastgroup]
+
+    if literals is not None:
+        # Containment alone tells if plain text keywords
+        # are present, searching first would scan twice
+        def process(line: bytes) -> bytes:
+            # Lowered once per line rather than once per keyword
+            text = line.lower() if ignore else line
+            if any(map(text.__contains__, literals)):
+                return sub(replace, line)
+            return basePrefix + line + reset if base else line
+    elif not configuration.anchored:
+        subn = configuration.pattern.subn
+
+        # Nothing cheaper than the pattern can rule out a line,
+        # so the substitution doubles as the search (one pass)
+        def process(line: bytes) -> bytes:
+            colored, count = subn(replace, line)
+            if count:
+                return colored
+            return basePrefix + line + reset if base else line
+    else:
+        # Anchored keywords are ruled out at the line start
+        def process(line: bytes) -> bytes:
+            if find(line) is not None:
+                return sub(replace, line)
+            return basePrefix + line + reset if base else line
+
+    return process
     # }}}
 
 
-def log_stderr(pipe, arguments: Arguments) -> None:
+def log_pipe(pipe, process, stdout: int) -> None:
+    """
+    Shared by both pipes, which only differ
+    in how a chunk of lines is processed
+    """
+    # log_pipe {{{
+    for lines, ending in read_lines(pipe):
+        write_lines(process(lines), ending, stdout)
+    # }}}
+
+
+def log_stderr(pipe, arguments: Arguments, stdout: int) -> None:
     # log_stderr {{{
-    if arguments.style == Style.Bit24:
-        red = "211,70,65"
-    elif arguments.style == Style.Bit8:
-        red = "160"
-    else:
-        red = "31"
+    red = {Style.Bit4: "31",
+           Style.Bit8: "160",
+           Style.Bit24: "211,70,65"}[arguments.style]
+
+    # Built once, every line is then just wrapped
+    prefix = ansi_prefix(red, arguments.style)
+    reset = RST_SUFFIX
 
-    for line in iter(pipe.readline, ""):
-        print(colorize(line, red, arguments.style), end="")
+    def process(lines: list) -> list:
+        return [prefix + line + reset for line in lines]
+
+    log_pipe(pipe, process, stdout)
     # }}}
 
 
 def log_stdout(pipe, configuration: Configuration,
-               arguments: Arguments) -> None:
+               arguments: Arguments, stdout: int) -> None:
     # log_stdout {{{
-    for line in iter(pipe.readline, ""):
-        skip:   bool = False  # Flag for continuation
-        output: bool = False  # Flag for print responsibility
-
-        for index, key in enumerate(configuration.keywords):
-            pattern = re.compile(key) if arguments.ignore is False \
-                    else re.compile(key, re.IGNORECASE)
-
-            if re.search(pattern, line) is not None:
-                color = configuration.colors[index]
-                skip = True
-
-                if arguments.mode == Mode.LINE:
-                    handle_line_mode(line, color, arguments.style)
-                    break  # Word mode supports multiple-match
-                else:
-                    output = True
-                    # Key is needed to ensure all
-                    # occurrences are colored
-                    line = handle_word_mode(line, key, color,
-                                            arguments.style, arguments.ignore)
-
-        if output:  # Simple way to allow multiple-match
-            print(line, end="")
-
-        if skip:  # Cleaner than nested conditionals
-            continue
-
-        # Handle the base color case
-        if configuration.hasBase:
-            print(colorize(line, configuration.baseColor,
-                           arguments.style), end="")
+    # Mode, base color, and pre-checks are decided
+    # once here rather than tested again per line
+    if configuration.pattern is None:
+        process = handle_patterns(configuration, arguments.mode,
+                                  configuration.hasBase)
+    else:
+        find = make_finder(configuration)
+        handle = handle_line_mode if arguments.mode == Mode.LINE \
+            else handle_word_mode
+        process = handle(configuration, find, configuration.hasBase)
+    log_pipe(pipe, handle_chunk(configuration, process,
+                                configuration.hasBase), stdout)
+    # }}}
+
+
+def make_finder(configuration: Configuration):
+    """
+    Builds the keyword search of a line,
+    returning the match or None
+    """
+    # make_finder {{{
+    # Anchored patterns need not be tried past the line start,
+    # otherwise a single scan finds the leftmost match of any
+    return configuration.pattern.match if configuration.anchored \
+        else configuration.pattern.search
+    # }}}
+
+
+def read_lines(pipe):
+    """
+    Yields the complete lines (without line
+    feeds) of whatever the pipe has available,
+    along with how the last line should end
+    """
+    # read_lines {{{
+    fd = pipe.fileno()
+    pending = []  # Incomplete until the next line feed
+    size = 0
+
+    # Bypasses the buffered reader, which
+    # would otherwise wait for a full chunk
+    while chunk := os.read(fd, CHUNK_SIZE):
+        pending.append(chunk)
+
+        # Joined only once a line ends, otherwise output
+        # without line feeds is copied again every read
+        if b"\n" in chunk:
+            lines = b"".join(pending).split(b"\n")
+            tail = lines.pop()
+            pending = [tail] if tail else []
+            size = len(tail)
+            yield lines, b"\n"
         else:
-            print(line, end="")
+            size += len(chunk)
+
+        # Progress (i.e., carriage returns) and overly long
+        # lines are passed on rather than held for a line feed
+        if pending and (chunk.endswith(b"\r") or size > CHUNK_SIZE):
+            yield [b"".join(pending)], b""
+            pending = []
+            size = 0
+
+    # Output may not end with a line feed
+    if pending:
+        yield [b"".join(pending)], b""
     # }}}
 
 
@@ -212,7 +518,30 @@ def set_arguments() -> Arguments:
                         help="Ignore case of matched word (no value expected)")
 
     parsed_args = parser.parse_args()
-    arguments = Arguments(parsed_args.command.split(" "))
+
+    if sys.platform == "win32":
+        # Windows programs parse their own command line,
+        # so it is kept whole, only the program is split off
+        command = parsed_args.command
+        valid = split_program(command)[0] != ""
+    else:
+        # Quotes group arguments containing spaces
+        try:
+            command = shlex.split(parsed_args.command)
+        except ValueError:  # i.e., No closing quotation
+            command = []
+        valid = len(command) > 0
+
+    if not valid:
+        # Raising an exception is better feedback on usage
+        # vs. default/silent handling
+        error = argparse.ArgumentTypeError("Invalid command! A program " +
+                                           "with balanced quotes expected")
+        parser.print_help()
+        print('\n')
+        raise error
+
+    arguments = Arguments(command)
 
     if parsed_args.file is not None:
         # This will be checked when
@@ -263,52 +592,146 @@ def set_arguments() -> Arguments:
 
 
 @handled
-def set_configuration(file: str, style: Style) -> Configuration:
+def set_configuration(file: str, style: Style,
+                      ignore: bool) -> Configuration:
     # set_configuration {{{
-    handle = open(file, "r")  # This may throw but is handled by decorator
-    content = handle.readlines()
-    configuration = Configuration([], [], 0, False)
-
-    for line in content:
-        line = line.strip()
-
-        # Easy enough to handle comments
-        # shouldn't be indented though
-        if line == "" or line[0] == "#":
-            continue
-
-        values = line.split("=")
-        if len(values) < 2:
-            raise Exception("Configuration must be in the "
-                            "following format [KEY]=[COLOR]")
-
-        keyword = values[0].strip()
-        color = values[1].strip()
-
-        # Though not necessary, if the configuration
-        # is invalid, this will produce a helpful
-        # indication vs. it just not working/coloring
-        if style == Style.Bit24:
-            split = color.split(",")
-            if len(split) != 3:
-                raise Exception("Invalid RGB color format "
-                                f"for {keyword}={color}")
-        else:
-            try:
-                int(color)
-            except Exception:
-                raise Exception("Color must be an integer")
-
-        if keyword.lower() == "base":
-            configuration.hasBase = True
-            configuration.baseColor = color
-        else:
-            configuration.keywords.append(keyword)
-            configuration.colors.append(color)
+    configuration = Configuration([], False, [], [])
+    # Keywords are matched against the raw output, which
+    # is expected in the same encoding as the terminal
+    encoding = locale.getpreferredencoding(False)
+
+    # This may throw but is handled by decorator
+    with open(file, "r") as handle:
+        for line in handle:
+            line = line.strip()
+
+            # Easy enough to handle comments
+            # shouldn't be indented though
+            if line == "" or line[0] == "#":
+                continue
+
+            # Partition stops at the first separator
+            keyword, separator, color = line.partition("=")
+            if separator == "":
+                raise Exception("Configuration must be in the "
+                                "following format [KEY]=[COLOR]")
+
+            keyword = keyword.strip()
+            color = color.strip()
+
+            # Though not necessary, if the configuration
+            # is invalid, this will produce a helpful
+            # indication vs. it just not working/coloring
+            if style == Style.Bit24:
+                split = color.split(",")
+                if len(split) != 3:
+                    raise Exception("Invalid RGB color format "
+                                    f"for {keyword}={color}")
+            else:
+                try:
+                    int(color)
+                except Exception:
+                    raise Exception("Color must be an integer")
+
+            if keyword.lower() == "base":
+                configuration.hasBase = True
+                configuration.basePrefix = ansi_prefix(color, style)
+            else:
+                prefix = ansi_prefix(color, style)
+                configuration.keywords.append(keyword.encode(encoding))
+                configuration.prefixes.append(prefix)
+                # Key is used (vs. the matched text) to
+                # stay consistent with the configuration
+                configuration.replacements.append(
+                    prefix + configuration.keywords[-1] + RST_SUFFIX)
+
+    flags = re.IGNORECASE if ignore else 0
+
+    # Compiled on their own first, so an invalid
+    # keyword is named rather than the alternation
+    patterns = []
+    for keyword in configuration.keywords:
+        try:
+            patterns.append(re.compile(keyword, flags))
+        except re.error as error:
+            raise Exception("Invalid keyword pattern "
+                            f"{keyword.decode(encoding)}: {error}")
+
+    # Keywords are fused into one alternation, compiled once,
+    # so each line is scanned a single time for all of them
+    groups = [b"(?P<k%d>%s)" % (index, keyword)
+              for index, keyword in enumerate(configuration.keywords)]
+    # Lookaheads try each keyword over the whole line in order,
+    # so the first configured one found determines the match
+    lookaheads = [b"(?=.*?%s)" % group for group in groups]
+    try:
+        if all(combinable(pattern, flags) for pattern in patterns):
+            # An empty alternation would match every line
+            configuration.pattern = re.compile(b"|".join(groups) or b"(?!)",
+                                               flags)
+            configuration.priority = re.compile(b"|".join(lookaheads) or
+                                                b"(?!)", flags)
+    except re.error:
+        # Group names may still clash between keywords
+        configuration.pattern = None
+
+    if configuration.pattern is None:
+        # Each keyword is then matched on its own instead
+        configuration.patterns = patterns
+
+    # Conservative, an alternation may hide an unanchored branch
+    configuration.anchored = len(configuration.keywords) > 0 and \
+        all(keyword.startswith(b"^") and b"|" not in keyword
+            for keyword in configuration.keywords)
+
+    # Plain text keywords allow a substring pre-check, when
+    # ignoring case they are lowered here once (bytes patterns
+    # fold ascii only, same as lowering the bytes of a line)
+    if not any(SPECIAL.intersection(keyword.decode(encoding))
+               for keyword in configuration.keywords):
+        configuration.literals = configuration.keywords if not ignore \
+            else [keyword.lower() for keyword in configuration.keywords]
 
     return configuration
     # }}}
 
 
+def split_program(command: str) -> tuple:
+    """
+    Splits the program off a Windows command
+    line, which (unlike its arguments) ends at
+    the closing quote or the first whitespace
+    """
+    # split_program {{{
+    match = re.match(r'\s*(?:"([^"]*)"?|(\S+))', command)
+    if match is None:
+        return "", command
+
+    program = match.group(1) if match.group(1) is not None \
+        else match.group(2)
+    return program, command[match.end():]
+    # }}}
+
+
+def write_lines(lines: list, ending: bytes, stdout: int) -> None:
+    # write_lines {{{
+    # A trailing empty line makes the join end with the line
+    # feed, rather than copying the whole chunk to append it
+    if ending:
+        lines.append(b"")
+
+    # Written once per chunk rather than once per line, and
+    # straight to the descriptor since sys.stdout would only
+    # add a copy and its own lock before the same syscall
+    output = memoryview(b"\n".join(lines))
+
+    # The lock keeps stdout and stderr chunks from interleaving
+    with WRITE_LOCK:
+        while output:
+            # Pipes may accept less than the whole chunk
+            output = output[os.write(stdout, output):]
+    # }}}
+
+
 if __name__ == '__main__':
     main()